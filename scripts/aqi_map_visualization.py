@@ -5,12 +5,77 @@ Creates an interactive map showing all AQI monitoring stations with color-coded
 """
 
 import os
+import glob
+import gzip
 import pandas as pd
+import numpy as np
 import folium
 from folium.plugins import MarkerCluster
-import json
+from branca.element import MacroElement
+from jinja2 import Environment, Template, Undefined
+import orjson
 from datetime import datetime
 
+# Popup HTML, compiled once; station values are HTML-escaped
+POPUP_ENVIRONMENT = Environment(autoescape=True)
+POPUP_ENVIRONMENT.tests['present'] = lambda value: not isinstance(value, Undefined) and pd.notna(value)
+POPUP_TEMPLATE = POPUP_ENVIRONMENT.from_string(
+    "<div style=\"font-family: 'Microsoft JhengHei', Arial, sans-serif; font-size: 12px;\">"
+    "<h4 style=\"margin: 5px 0; color: #333;\">{{ station.site_name }}</h4>"
+    "<p style=\"margin: 3px 0;\"><strong>縣市:</strong> {{ station.county }}</p>"
+    "<p style=\"margin: 3px 0;\"><strong>AQI:</strong> "
+    "<span style=\"font-size: 16px; font-weight: bold; color: {{ station.aqi_color }};\">{{ station.aqi if station.aqi is present else 'N/A' }}</span></p>"
+    "<p style=\"margin: 3px 0;\"><strong>狀態:</strong> {{ station.aqi_category }}</p>"
+    "<p style=\"margin: 3px 0;\"><strong>主要污染物:</strong> "
+    "{{ station.pollutant if station.pollutant is present else 'N/A' }}</p>"
+    "{% if station.pm25 is present %}<p style='margin: 3px 0;'><strong>PM2.5:</strong> {{ station.pm25 }}</p>{% endif %}"
+    "{% if station.pm10 is present %}<p style='margin: 3px 0;'><strong>PM10:</strong> {{ station.pm10 }}</p>{% endif %}"
+    "{% if station.data_time is present %}<p style='margin: 3px 0;'><strong>更新時間:</strong> {{ station.data_time }}</p>{% endif %}"
+    "</div>"
+)
+
+class StationLayer(MacroElement):
+    """
+    GeoJSON layer of AQI station markers
+    Features are embedded in the page (data) or fetched from a file next to it (url)
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var options = {
+                pointToLayer: function (feature, latlng) {
+                    return L.circleMarker(latlng, {
+                        radius: 8,
+                        color: 'black',
+                        weight: 1,
+                        fillColor: feature.properties.color,
+                        fillOpacity: 0.8
+                    });
+                },
+                onEachFeature: function (feature, layer) {
+                    layer.bindPopup(feature.properties.popup, {maxWidth: 300});
+                    layer.bindTooltip(feature.properties.tooltip, {sticky: true});
+                }
+            };
+            {%- if this.url %}
+            fetch({{ this.url|tojson }})
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    {{ this._parent.get_name() }}.addLayer(L.geoJson(data, options));
+                });
+            {%- else %}
+            {{ this._parent.get_name() }}.addLayer(L.geoJson({{ this.data|tojson }}, options));
+            {%- endif %}
+        })();
+        {% endmacro %}
+    """)
+    
+    def __init__(self, data=None, url=None):
+        super().__init__()
+        self._name = 'StationLayer'
+        self.data = data
+        self.url = url
+
 class AQIMapVisualizer:
     def __init__(self):
         self.aqi_colors = {
@@ -39,6 +104,21 @@ class AQIMapVisualizer:
             'very_unhealthy': '非常不健康 (201-300)',
             'hazardous': '危害 (301-500)'
         }
+        
+        # Static map page and the station data it loads, both under outputs/
+        self.map_file = 'aqi_map.html'
+        self.stations_file = 'aqi_map_stations.json'
+        
+        # Lookup tables indexed by AQI + 1: slot 0 is missing data, the last slot is out of range
+        max_aqi = max(max_val for _, max_val in self.aqi_ranges.values())
+        self._category_lut = np.full(max_aqi + 3, -1, dtype=np.int8)
+        self._color_lut = np.full(max_aqi + 3, '#808080', dtype=object)
+        self._label_lut = np.full(max_aqi + 3, '超出範圍', dtype=object)
+        self._label_lut[0] = '無資料'
+        for code, (category, (min_val, max_val)) in enumerate(self.aqi_ranges.items()):
+            self._category_lut[min_val + 1:max_val + 2] = code
+            self._color_lut[min_val + 1:max_val + 2] = self.aqi_colors[category]
+            self._label_lut[min_val + 1:max_val + 2] = self.aqi_labels[category]
     
     def get_aqi_color(self, aqi_value):
         """Get color based on AQI value"""
@@ -62,83 +142,112 @@ class AQIMapVisualizer:
         
         return '超出範圍'
     
+    def aqi_lut_index(self, aqi_values):
+        """Map a Series of AQI values to positions in the lookup tables built in __init__"""
+        values = aqi_values.to_numpy(dtype=np.float64, na_value=np.nan)
+        index = np.full(len(values), len(self._category_lut) - 1, dtype=np.intp)
+        # Fractional values fall between the integer ranges, as in get_aqi_category
+        in_range = (values >= 0) & (values <= len(self._category_lut) - 3) & (values == np.floor(values))
+        index[in_range] = values[in_range].astype(np.intp) + 1
+        index[np.isnan(values)] = 0
+        return index
+    
+    def categorize_aqi(self, aqi_values):
+        """Bin a Series of AQI values into the categories of aqi_ranges"""
+        codes = self._category_lut[self.aqi_lut_index(aqi_values)]
+        categories = pd.Categorical.from_codes(codes, categories=list(self.aqi_ranges))
+        return pd.Series(categories, index=aqi_values.index)
+    
     def load_aqi_data(self, csv_file):
-        """Load AQI data from CSV file"""
+        """Load AQI data from CSV file (or the Parquet copy written by aqi_monitor.py)"""
         try:
-            df = pd.read_csv(csv_file, encoding='utf-8-sig')
+            if csv_file.endswith('.parquet'):
+                df = pd.read_parquet(csv_file)
+            else:
+                df = pd.read_csv(csv_file, encoding='utf-8-sig')
             print(f"Loaded {len(df)} stations from {csv_file}")
             return df
         except Exception as e:
             print(f"Error loading CSV file: {e}")
             return None
     
-    def create_popup_content(self, station):
-        """Create HTML content for popup window"""
-        aqi_value = station['aqi']
-        category = self.get_aqi_category(aqi_value)
-        color = self.get_aqi_color(aqi_value)
-        
-        popup_html = f"""
-        <div style="font-family: 'Microsoft JhengHei', Arial, sans-serif; font-size: 12px;">
-            <h4 style="margin: 5px 0; color: #333;">{station['site_name']}</h4>
-            <p style="margin: 3px 0;"><strong>縣市:</strong> {station['county']}</p>
-            <p style="margin: 3px 0;"><strong>AQI:</strong> 
-                <span style="font-size: 16px; font-weight: bold; color: {color};">{aqi_value}</span>
-            </p>
-            <p style="margin: 3px 0;"><strong>狀態:</strong> {category}</p>
-            <p style="margin: 3px 0;"><strong>主要污染物:</strong> {station.get('pollutant', 'N/A')}</p>
-            {f"<p style='margin: 3px 0;'><strong>PM2.5:</strong> {station['pm25']}</p>" if pd.notna(station.get('pm25')) else ""}
-            {f"<p style='margin: 3px 0;'><strong>PM10:</strong> {station['pm10']}</p>" if pd.notna(station.get('pm10')) else ""}
-            {f"<p style='margin: 3px 0;'><strong>更新時間:</strong> {station.get('data_time', 'N/A')}</p>" if pd.notna(station.get('data_time')) else ""}
-        </div>
-        """
-        return popup_html
+    def create_popup_content(self, stations):
+        """Create HTML content for the popup window of every station"""
+        popups = [POPUP_TEMPLATE.render(station=station) for station in stations.itertuples(index=False)]
+        return pd.Series(popups, index=stations.index, dtype=object)
     
-    def create_aqi_map(self, df):
-        """Create interactive AQI map"""
+    def prepare_stations(self, df):
+        """Filter stations with valid coordinates and add marker color, label and popup columns"""
+        valid_stations = df.dropna(subset=['latitude', 'longitude']).copy()
+        
+        # Assign color and category label to every station with one table lookup
+        lut_index = self.aqi_lut_index(valid_stations['aqi'])
+        valid_stations['aqi_color'] = self._color_lut[lut_index]
+        valid_stations['aqi_category'] = self._label_lut[lut_index]
+        
+        valid_stations['popup_html'] = self.create_popup_content(valid_stations)
+        
+        return valid_stations
+    
+    def create_station_geojson(self, stations):
+        """Build a GeoJSON FeatureCollection with one point feature per prepared station"""
+        # Fill missing values before astype(str), which gives 'nan'/'<NA>' or NaN depending on pandas
+        site_names = stations['site_name'].astype(object).where(stations['site_name'].notna(), 'N/A')
+        aqi_values = stations['aqi'].astype(object).where(stations['aqi'].notna(), 'N/A')
+        tooltips = site_names.astype(str) + ' - AQI: ' + aqi_values.astype(str)
+        
+        # [lon, lat] pairs straight from one float64 block; tolist() yields plain floats for JSON
+        coordinates = stations[['longitude', 'latitude']].to_numpy(dtype=np.float64).tolist()
+        
+        features = [
+            {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': coordinate},
+                'properties': {'color': color, 'popup': popup, 'tooltip': tooltip}
+            }
+            for coordinate, color, popup, tooltip in zip(
+                coordinates,
+                stations['aqi_color'].tolist(),
+                stations['popup_html'].tolist(),
+                tooltips.tolist()
+            )
+        ]
+        
+        return {'type': 'FeatureCollection', 'features': features}
+    
+    def create_aqi_map(self, df, stations_url=None):
+        """
+        Create interactive AQI map
+        Station markers are embedded in the page, or loaded from stations_url
+        (a GeoJSON file written by save_results) when it is given
+        """
         if df is None:
             return None
         
         # Filter stations with valid coordinates
-        valid_stations = df.dropna(subset=['latitude', 'longitude']).copy()
+        valid_stations = df.dropna(subset=['latitude', 'longitude'])
         print(f"Creating map with {len(valid_stations)} stations with valid coordinates")
         
         # Calculate center point of Taiwan
         center_lat = valid_stations['latitude'].mean()
         center_lon = valid_stations['longitude'].mean()
         
-        # Create base map
+        # Create base map; markers are drawn on a single canvas
         m = folium.Map(
             location=[center_lat, center_lon],
             zoom_start=7,
-            tiles='OpenStreetMap'
+            tiles='OpenStreetMap',
+            prefer_canvas=True
         )
         
         # Create marker cluster for better performance
         marker_cluster = MarkerCluster().add_to(m)
         
-        # Add markers for each station
-        for idx, station in valid_stations.iterrows():
-            aqi_value = station['aqi']
-            color = self.get_aqi_color(aqi_value)
-            
-            # Create popup content
-            popup_content = self.create_popup_content(station)
-            
-            # Create tooltip
-            tooltip = f"{station['site_name']} - AQI: {aqi_value}"
-            
-            # Add marker
-            folium.CircleMarker(
-                location=[station['latitude'], station['longitude']],
-                radius=8,
-                popup=folium.Popup(popup_content, max_width=300),
-                tooltip=tooltip,
-                color='black',
-                weight=1,
-                fillColor=color,
-                fillOpacity=0.8
-            ).add_to(marker_cluster)
+        # Add all stations as one GeoJSON layer; markers are styled in the browser
+        if stations_url is None:
+            StationLayer(data=self.create_station_geojson(self.prepare_stations(df))).add_to(marker_cluster)
+        else:
+            StationLayer(url=stations_url).add_to(marker_cluster)
         
         # Add legend
         legend_html = '''
@@ -182,51 +291,63 @@ class AQIMapVisualizer:
             return None
         
         # Count stations in each AQI category
-        category_counts = {}
-        for category, (min_val, max_val) in self.aqi_ranges.items():
-            count = len(df[(df['aqi'] >= min_val) & (df['aqi'] <= max_val)])
-            category_counts[category] = count
+        counts = self.categorize_aqi(df['aqi']).value_counts()
+        category_counts = {category: int(counts[category]) for category in self.aqi_ranges}
         
         # Add missing data count
-        missing_count = len(df[df['aqi'].isna()])
+        missing_count = int(df['aqi'].isna().sum())
         if missing_count > 0:
             category_counts['missing'] = missing_count
         
         # Calculate statistics
-        valid_aqi = df[df['aqi'].notna()]['aqi']
+        stations_with_data = len(df) - missing_count
+        stats = df['aqi'].agg(['max', 'min', 'mean', 'median'])
         
         summary = {
             'total_stations': len(df),
-            'stations_with_data': len(valid_aqi),
+            'stations_with_data': stations_with_data,
             'stations_missing_data': missing_count,
             'category_distribution': category_counts,
             'statistics': {
-                'max_aqi': int(valid_aqi.max()) if len(valid_aqi) > 0 else None,
-                'min_aqi': int(valid_aqi.min()) if len(valid_aqi) > 0 else None,
-                'avg_aqi': round(valid_aqi.mean(), 1) if len(valid_aqi) > 0 else None,
-                'median_aqi': int(valid_aqi.median()) if len(valid_aqi) > 0 else None
+                'max_aqi': int(stats['max']) if stations_with_data > 0 else None,
+                'min_aqi': int(stats['min']) if stations_with_data > 0 else None,
+                'avg_aqi': round(float(stats['mean']), 1) if stations_with_data > 0 else None,
+                'median_aqi': int(stats['median']) if stations_with_data > 0 else None
             },
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
         
         return summary
     
-    def save_results(self, map_obj, summary):
-        """Save map and summary to files"""
+    def write_with_gzip(self, path, content):
+        """Write content to path plus a pre-compressed path.gz for servers that serve it with Content-Encoding: gzip"""
+        with open(path, 'wb') as f:
+            f.write(content)
+        with open(f'{path}.gz', 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=6))
+    
+    def save_results(self, map_obj, stations_geojson, summary):
+        """Save map, station data and summary to files"""
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         outputs_dir = os.path.join(os.path.dirname(__file__), '..', 'outputs')
         os.makedirs(outputs_dir, exist_ok=True)
         
-        # Save map as HTML file
-        map_file = os.path.join(outputs_dir, f'aqi_map_{timestamp}.html')
-        map_obj.save(map_file)
+        # Save the map page only once; later runs just refresh the station data it loads
+        map_file = os.path.join(outputs_dir, self.map_file)
+        if not os.path.exists(map_file):
+            self.write_with_gzip(map_file, map_obj.get_root().render().encode('utf-8'))
+            print(f"Map saved: {map_file}")
+        
+        # Save station markers as GeoJSON
+        stations_file = os.path.join(outputs_dir, self.stations_file)
+        self.write_with_gzip(stations_file, orjson.dumps(stations_geojson))
         
         # Save summary as JSON
         summary_file = os.path.join(outputs_dir, f'aqi_map_summary_{timestamp}.json')
-        with open(summary_file, 'w', encoding='utf-8') as f:
-            json.dump(summary, f, ensure_ascii=False, indent=2)
+        with open(summary_file, 'wb') as f:
+            f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
         
-        print(f"Map saved: {map_file}")
+        print(f"Station data saved: {stations_file}")
         print(f"Summary saved: {summary_file}")
         
         return map_file, summary_file
@@ -269,15 +390,17 @@ class AQIMapVisualizer:
         
         # Create map
         print(f"\nCreating interactive map...")
-        map_obj = self.create_aqi_map(df)
+        map_obj = self.create_aqi_map(df, stations_url=self.stations_file)
         
         if map_obj is None:
             print("Failed to create map. Exiting.")
             return
         
+        stations_geojson = self.create_station_geojson(self.prepare_stations(df))
+        
         # Save results
         print("Saving results...")
-        map_file, summary_file = self.save_results(map_obj, summary)
+        map_file, summary_file = self.save_results(map_obj, stations_geojson, summary)
         
         print(f"\n=== Map Features ===")
         print("- 互動式地圖可縮放和平移")
@@ -287,21 +410,28 @@ class AQIMapVisualizer:
         print("- 支援測站群集顯示")
         
         print(f"\nMap visualization completed!")
-        print(f"Open {map_file} in your browser to view the interactive map.")
+        print(f"Serve the outputs directory (e.g. python -m http.server -d outputs) and open {self.map_file} to view the interactive map.")
         
         return map_file, summary_file
 
 if __name__ == "__main__":
     # Find the most recent all AQI data CSV file
     outputs_dir = os.path.join(os.path.dirname(__file__), '..', 'outputs')
-    csv_files = [f for f in os.listdir(outputs_dir) if f.startswith('all_aqi_data_') and f.endswith('.csv')]
+    pointer_file = os.path.join(outputs_dir, 'latest_all_aqi.txt')
+    
+    if os.path.exists(pointer_file):
+        # Written by aqi_monitor.py on every run
+        with open(pointer_file, encoding='utf-8') as f:
+            latest_file = f.read().strip()
+    else:
+        # Older outputs without a pointer: scan the directory
+        csv_files = glob.glob(os.path.join(outputs_dir, 'all_aqi_data_*.csv'))
+        latest_file = os.path.basename(max(csv_files)) if csv_files else None
     
-    if not csv_files:
+    if not latest_file:
         print("No all AQI data CSV files found in outputs directory.")
         print("Please run aqi_monitor.py first to generate the data.")
     else:
-        # Get the most recent file
-        latest_file = sorted(csv_files)[-1]
         csv_path = os.path.join(outputs_dir, latest_file)
         
         print(f"Using latest file: {latest_file}")
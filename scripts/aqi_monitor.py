@@ -6,21 +6,15 @@ Fetches real-time AQI data from MOENV API and identifies stations with AQI > 50
 
 import os
 import requests
-import json
+import orjson
 import pandas as pd
 from datetime import datetime
 from dotenv import load_dotenv
-import matplotlib.pyplot as plt
-import seaborn as sns
 import urllib3
 
 # Disable SSL warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# Set matplotlib font for Chinese characters
-plt.rcParams['font.sans-serif'] = ['Microsoft JhengHei', 'SimHei', 'Arial Unicode MS']
-plt.rcParams['axes.unicode_minus'] = False
-
 # Load environment variables
 load_dotenv()
 
@@ -33,9 +27,43 @@ class AQIMonitor:
         self.base_url = "https://data.moenv.gov.tw/api/v2"
         self.aqi_endpoint = f"{self.base_url}/aqx_p_432"
         self.headers = {
-            'accept': 'application/json'
+            'accept': 'application/json',
+            'accept-encoding': 'gzip'
         }
         
+        # Reuse one connection across polls
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        
+        # API field -> output column, in output column order
+        self.column_map = {
+            'siteid': 'site_id',
+            'sitename': 'site_name',
+            'county': 'county',
+            'aqi': 'aqi',
+            'pollutant': 'pollutant',
+            'status': 'status',
+            'pm2.5': 'pm25',
+            'pm10': 'pm10',
+            'so2': 'so2',
+            'no2': 'no2',
+            'co': 'co',
+            'o3': 'o3',
+            'windspeed': 'wind_speed',
+            'winddirec': 'wind_direction',
+            'datacreationdate': 'data_time',
+            'latitude': 'latitude',
+            'longitude': 'longitude'
+        }
+        
+        self.numeric_columns = [
+            'aqi', 'pm25', 'pm10', 'so2', 'no2', 'co', 'o3',
+            'wind_speed', 'wind_direction', 'latitude', 'longitude'
+        ]
+        
+        # Low-cardinality text columns stored as categoricals
+        self.category_columns = ['county', 'status', 'pollutant']
+        
     def fetch_aqi_data(self):
         """Fetch real-time AQI data from MOENV API"""
         try:
@@ -44,94 +72,68 @@ class AQIMonitor:
                 'limit': 100  # Get all stations
             }
             
-            response = requests.get(self.aqi_endpoint, params=params, headers=self.headers, verify=False)
+            response = self.session.get(self.aqi_endpoint, params=params, verify=False)
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             print(f"Successfully fetched {len(data)} records")
             return data
             
         except requests.exceptions.RequestException as e:
             print(f"Error fetching data: {e}")
             return None
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"Error parsing JSON response: {e}")
             return None
     
     def process_aqi_data(self, raw_data):
-        """Process raw AQI data into structured format"""
+        """Process raw AQI data into a DataFrame"""
         if not raw_data:
             return None
-            
-        processed_data = []
-        for record in raw_data:
-            try:
-                processed_record = {
-                    'site_id': record.get('siteid'),
-                    'site_name': record.get('sitename'),
-                    'county': record.get('county'),
-                    'aqi': int(record.get('aqi', 0)) if record.get('aqi') else None,
-                    'pollutant': record.get('pollutant'),
-                    'status': record.get('status'),
-                    'pm25': float(record.get('pm2.5', 0)) if record.get('pm2.5') else None,
-                    'pm10': float(record.get('pm10', 0)) if record.get('pm10') else None,
-                    'so2': float(record.get('so2', 0)) if record.get('so2') else None,
-                    'no2': float(record.get('no2', 0)) if record.get('no2') else None,
-                    'co': float(record.get('co', 0)) if record.get('co') else None,
-                    'o3': float(record.get('o3', 0)) if record.get('o3') else None,
-                    'wind_speed': float(record.get('windspeed', 0)) if record.get('windspeed') else None,
-                    'wind_direction': float(record.get('winddirec', 0)) if record.get('winddirec') else None,
-                    'data_time': record.get('datacreationdate'),
-                    'latitude': float(record.get('latitude', 0)) if record.get('latitude') else None,
-                    'longitude': float(record.get('longitude', 0)) if record.get('longitude') else None
-                }
-                processed_data.append(processed_record)
-            except (ValueError, TypeError) as e:
-                print(f"Error processing record {record.get('sitename', 'Unknown')}: {e}")
-                continue
-                
-        return processed_data
-    
-    def identify_high_aqi_stations(self, processed_data, threshold=50):
-        """Identify stations with AQI > threshold"""
-        if not processed_data:
-            return []
-            
-        high_aqi_stations = [
-            station for station in processed_data 
-            if station['aqi'] and station['aqi'] > threshold
-        ]
         
-        # Sort by AQI value (descending)
-        high_aqi_stations.sort(key=lambda x: x['aqi'], reverse=True)
+        df = pd.DataFrame(raw_data).rename(columns=self.column_map)
+        df = df.reindex(columns=list(self.column_map.values()))
+        
+        # Convert all numeric columns at once; empty or invalid values become NaN
+        df[self.numeric_columns] = df[self.numeric_columns].apply(pd.to_numeric, errors='coerce')
+        # AQI readings are whole numbers; nullable Int64 keeps them printing as 122, not 122.0.
+        # A fractional reading is treated as invalid (NA) rather than aborting the cast
+        df['aqi'] = df['aqi'].where(df['aqi'].mod(1).eq(0)).astype('Int64')
+        df[self.category_columns] = df[self.category_columns].astype('category')
         
-        return high_aqi_stations
+        return df
+    
+    def identify_high_aqi_stations(self, df, threshold=50):
+        """Identify stations with AQI > threshold"""
+        # Sort by AQI value (descending), keeping API order for equal values
+        return df.loc[df['aqi'].gt(threshold)].sort_values('aqi', ascending=False, kind='stable')
     
-    def generate_summary(self, processed_data, high_aqi_stations):
+    def generate_summary(self, df, high_aqi_stations):
         """Generate summary statistics"""
-        if not processed_data:
+        if df is None or df.empty:
             return None
             
-        total_stations = len(processed_data)
+        total_stations = len(df)
         high_aqi_count = len(high_aqi_stations)
         
         # Calculate statistics
-        aqi_values = [s['aqi'] for s in processed_data if s['aqi'] is not None]
+        stats = df['aqi'].dropna().agg(['max', 'min', 'mean', 'count'])
+        aqi_count = int(stats['count'])
         
         summary = {
             'total_stations': total_stations,
-            'stations_with_aqi_data': len(aqi_values),
+            'stations_with_aqi_data': aqi_count,
             'high_aqi_stations': high_aqi_count,
             'percentage_high_aqi': (high_aqi_count / total_stations) * 100 if total_stations > 0 else 0,
-            'max_aqi': max(aqi_values) if aqi_values else None,
-            'min_aqi': min(aqi_values) if aqi_values else None,
-            'avg_aqi': sum(aqi_values) / len(aqi_values) if aqi_values else None,
+            'max_aqi': int(stats['max']) if aqi_count > 0 else None,
+            'min_aqi': int(stats['min']) if aqi_count > 0 else None,
+            'avg_aqi': float(stats['mean']) if aqi_count > 0 else None,
             'data_timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
         
         return summary
     
-    def save_results(self, processed_data, high_aqi_stations, summary):
+    def save_results(self, df, high_aqi_stations, summary):
         """Save results to files"""
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         
@@ -139,32 +141,51 @@ class AQIMonitor:
         outputs_dir = os.path.join(os.path.dirname(__file__), '..', 'outputs')
         os.makedirs(outputs_dir, exist_ok=True)
         
-        # Save all data
-        all_df = pd.DataFrame(processed_data)
-        all_df.to_csv(os.path.join(outputs_dir, f'all_aqi_data_{timestamp}.csv'), index=False, encoding='utf-8-sig')
+        # Save all data (CSV for spreadsheets and the other scripts, Parquet for analysis)
+        df.to_csv(os.path.join(outputs_dir, f'all_aqi_data_{timestamp}.csv'), index=False, encoding='utf-8-sig')
+        df.to_parquet(os.path.join(outputs_dir, f'all_aqi_data_{timestamp}.parquet'), compression='zstd', index=False)
+        
+        # Point the map visualizer at the newest all-stations CSV
+        with open(os.path.join(outputs_dir, 'latest_all_aqi.txt'), 'w', encoding='utf-8') as f:
+            f.write(f'all_aqi_data_{timestamp}.csv')
         
         # Save high AQI stations
-        high_aqi_df = pd.DataFrame(high_aqi_stations)
-        high_aqi_df.to_csv(os.path.join(outputs_dir, f'high_aqi_stations_{timestamp}.csv'), index=False, encoding='utf-8-sig')
+        high_aqi_stations.to_csv(os.path.join(outputs_dir, f'high_aqi_stations_{timestamp}.csv'), index=False, encoding='utf-8-sig')
+        high_aqi_stations.to_parquet(os.path.join(outputs_dir, f'high_aqi_stations_{timestamp}.parquet'), compression='zstd', index=False)
         
         # Save summary
-        with open(os.path.join(outputs_dir, f'aqi_summary_{timestamp}.json'), 'w', encoding='utf-8') as f:
-            json.dump(summary, f, ensure_ascii=False, indent=2)
+        with open(os.path.join(outputs_dir, f'aqi_summary_{timestamp}.json'), 'wb') as f:
+            f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
         
         print(f"Results saved with timestamp: {timestamp}")
         
     def create_visualization(self, high_aqi_stations):
         """Create visualization of high AQI stations"""
-        if not high_aqi_stations:
+        if high_aqi_stations.empty:
             print("No high AQI stations to visualize")
             return
-            
-        # Prepare data for visualization
-        df = pd.DataFrame(high_aqi_stations)
+        
+        # Imported here so monitoring runs that skip the chart don't pay for matplotlib
+        import matplotlib.pyplot as plt
+        from matplotlib.patches import Patch
+        
+        # Set matplotlib font for Chinese characters
+        plt.rcParams['font.sans-serif'] = ['Microsoft JhengHei', 'SimHei', 'Arial Unicode MS']
+        plt.rcParams['axes.unicode_minus'] = False
+        
+        # One color per county, in order of first appearance
+        top_stations = high_aqi_stations.nlargest(20, 'aqi')
+        counties = top_stations['county'].drop_duplicates().tolist()
+        palette = plt.get_cmap('tab10')
+        county_colors = {county: palette(i % palette.N) for i, county in enumerate(counties)}
         
         # Create bar chart
         plt.figure(figsize=(12, 8))
-        sns.barplot(data=df.head(20), x='aqi', y='site_name', hue='county')
+        plt.barh(top_stations['site_name'], top_stations['aqi'],
+                 color=[county_colors[county] for county in top_stations['county']])
+        plt.gca().invert_yaxis()
+        plt.legend(handles=[Patch(color=color, label=county) for county, color in county_colors.items()],
+                   title='county')
         plt.title('Top 20 Stations with AQI > 50', fontsize=16)
         plt.xlabel('AQI Value', fontsize=12)
         plt.ylabel('Station Name', fontsize=12)
@@ -194,18 +215,18 @@ class AQIMonitor:
         
         # Process data
         print("Processing data...")
-        processed_data = self.process_aqi_data(raw_data)
+        df = self.process_aqi_data(raw_data)
         
-        if not processed_data:
+        if df is None or df.empty:
             print("Failed to process data. Exiting.")
             return
         
         # Identify high AQI stations
         print("Identifying stations with AQI > 50...")
-        high_aqi_stations = self.identify_high_aqi_stations(processed_data)
+        high_aqi_stations = self.identify_high_aqi_stations(df)
         
         # Generate summary
-        summary = self.generate_summary(processed_data, high_aqi_stations)
+        summary = self.generate_summary(df, high_aqi_stations)
         
         # Display results
         print(f"\n=== Summary ===")
@@ -217,12 +238,12 @@ class AQIMonitor:
         print(f"Average AQI: {summary['avg_aqi']:.1f}")
         
         print(f"\n=== Stations with AQI > 50 ({len(high_aqi_stations)} stations) ===")
-        for station in high_aqi_stations:
-            print(f"{station['site_name']} ({station['county']}): AQI = {station['aqi']} - {station['status']}")
+        for station in high_aqi_stations.itertuples(index=False):
+            print(f"{station.site_name} ({station.county}): AQI = {station.aqi} - {station.status}")
         
         # Save results
         print("\nSaving results...")
-        self.save_results(processed_data, high_aqi_stations, summary)
+        self.save_results(df, high_aqi_stations, summary)
         
         # Create visualization
         print("Creating visualization...")